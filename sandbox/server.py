@@ -4,8 +4,24 @@ import docker
 from fastmcp import FastMCP
 from pathlib import Path
 import ast
+import hashlib
+import json
+import mmap
+import re
+import shlex
+import struct
 import textwrap
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from packaging.specifiers import InvalidSpecifier, SpecifierSet
+from packaging.version import InvalidVersion, Version
+from docker.models.containers import ExecResult
 
 load_dotenv()
 
@@ -15,12 +31,27 @@ GITHUB_USER = os.getenv("GITHUB_USERNAME")
 REPO_OWNER = os.getenv("REPO_OWNER")
 REPO_NAME = os.getenv("REPO_NAME")
 
-mcp = FastMCP("DockerSandbox")
-client = docker.from_env()
-
 # --- CONFIGURATION ---
 CONTAINER_NAME = "agent_sandbox"
 IMAGE_NAME = "agent_sandbox_image"
+DOCKER_TIMEOUT = 600  # Seconds; matches the agent's TOOL_TIMEOUT so long installs aren't cut off
+OUTPUT_LIMIT = 1_000_000  # Bytes of command output kept (tail) per call
+READ_CACHE_SIZE = 256  # Files kept in memory by read_file
+AST_CACHE_SIZE = 128   # Syntax-check results kept by content hash
+MMAP_THRESHOLD = 64 * 1024  # Files at least this big are pre-scanned via mmap before decoding
+PYPI_WORKERS = 32      # Concurrent PyPI metadata lookups
+PYPI_CACHE_TTL = 3600  # Seconds a package's latest version is trusted
+
+mcp = FastMCP("DockerSandbox")
+
+# Docker client, created on first use: from_env() probes the daemon's API version over HTTP
+_CLIENT = None
+
+def _client():
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = docker.from_env(timeout=DOCKER_TIMEOUT)
+    return _CLIENT
 
 # FIX: Use a dedicated subfolder to avoid polluting the agent's own code
 # AND ensure Docker mounts this specific folder.
@@ -31,16 +62,22 @@ if not MOUNT_DIR.exists():
     MOUNT_DIR.mkdir(parents=True)
     print(f"Created workspace directory at: {MOUNT_DIR}")
 
+# Container handle, resolved once per process instead of once per tool call
+_CONTAINER = None
+
 def _get_container():
+    global _CONTAINER
+    if _CONTAINER is not None:
+        return _CONTAINER
     try:
-        container = client.containers.get(CONTAINER_NAME)
+        container = _client().containers.get(CONTAINER_NAME)
         if container.status != "running":
             container.start()
-        return container
+        _CONTAINER = container
     except docker.errors.NotFound:
         print(f"Starting container with mount: {MOUNT_DIR} -> /workspace")
-        client.images.build(path="sandbox", tag=IMAGE_NAME)
-        return client.containers.run(
+        _client().images.build(path="sandbox", tag=IMAGE_NAME)
+        _CONTAINER = _client().containers.run(
             IMAGE_NAME, 
             name=CONTAINER_NAME, 
             detach=True, 
@@ -48,6 +85,97 @@ def _get_container():
             # CRITICAL: This binds the local folder to the docker folder
             volumes={str(MOUNT_DIR): {'bind': '/workspace', 'mode': 'rw'}}
         )
+    return _CONTAINER
+
+class _ShellSession:
+    """A long-lived bash inside the sandbox; each command's output is framed by a sentinel."""
+
+    def __init__(self, container):
+        exec_id = _client().api.exec_create(
+            container.id, ["bash"], stdin=True, tty=False, workdir="/workspace"
+        )["Id"]
+        self._handle = _client().api.exec_start(exec_id, socket=True)  # Keeps the HTTP response alive
+        self._sock = getattr(self._handle, "_sock", self._handle)  # SocketIO wraps the real socket
+        self._sock.settimeout(DOCKER_TIMEOUT)
+        self._marker = f"__END_{uuid.uuid4().hex}_"
+        self._end_re = re.compile(rf"{self._marker}(\d+)__\n".encode())
+
+    def send(self, cmd: str):
+        # Subshell keeps `cd`/`exit` from leaking into the session; eval turns syntax errors
+        # into exit codes instead of a hung parser; </dev/null stops commands eating our stdin.
+        line = f"(eval {shlex.quote(cmd)}) </dev/null 2>&1; echo \"{self._marker}$?__\"\n"
+        self._sock.sendall(line.encode("utf-8"))
+
+    def _recv_exactly(self, n: int) -> bytes:
+        data = b""
+        while len(data) < n:
+            chunk = self._sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("Sandbox shell closed unexpectedly.")
+            data += chunk
+        return data
+
+    def read_result(self) -> ExecResult:
+        buf = bytearray()
+        truncated = False
+        while True:
+            # Non-tty exec streams are multiplexed: 8-byte header (stream id, size) + payload
+            _, size = struct.unpack(">BxxxL", self._recv_exactly(8))
+            start = max(0, len(buf) - len(self._marker) - 16)
+            buf += self._recv_exactly(size)
+            m = self._end_re.search(buf, start)
+            if m:
+                output = bytes(buf[:m.start()])
+                if truncated:
+                    output = b"[... earlier output truncated ...]\n" + output
+                return ExecResult(int(m.group(1)), output)
+            if len(buf) > OUTPUT_LIMIT:
+                # Keep only the tail (errors usually come last); don't split a UTF-8 sequence
+                cut = len(buf) - OUTPUT_LIMIT
+                while cut < len(buf) and buf[cut] & 0xC0 == 0x80:
+                    cut += 1
+                del buf[:cut]
+                truncated = True
+
+    def close(self):
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+_SHELL = None
+_GIT_CONFIGURED = False  # Global git config lives in the container, so it is reset with it
+_SHELL_LOCK = threading.Lock()  # guards the shared shell socket; FastMCP runs sync tools inline, so this only keeps access serialized
+
+def _open_shell() -> _ShellSession:
+    global _CONTAINER, _GIT_CONFIGURED
+    try:
+        return _ShellSession(_get_container())
+    except (docker.errors.NotFound, docker.errors.APIError):
+        # Stale handle (container removed/stopped): look it up again and retry once
+        _CONTAINER = None
+        _GIT_CONFIGURED = False
+        return _ShellSession(_get_container())
+
+def _exec(cmd: str) -> ExecResult:
+    """Runs a command in /workspace through the persistent sandbox shell."""
+    global _SHELL
+    with _SHELL_LOCK:
+        if _SHELL is None:
+            _SHELL = _open_shell()
+        try:
+            _SHELL.send(cmd)
+        except OSError:
+            # Session died since the last call; nothing ran yet, so reopen and resend once
+            _SHELL.close()
+            _SHELL = _open_shell()
+            _SHELL.send(cmd)
+        try:
+            return _SHELL.read_result()
+        except OSError:
+            _SHELL.close()
+            _SHELL = None
+            raise
 
 def _sanitize_path(filename: str) -> Path:
     """Ensures file operations happen INSIDE the workspace_mount."""
@@ -59,24 +187,50 @@ def _sanitize_path(filename: str) -> Path:
     
     target_path = (MOUNT_DIR / clean_name).resolve()
     
-    # Security: Prevent escaping the workspace_mount
-    if not str(target_path).startswith(str(MOUNT_DIR)):
+    # Security: Prevent escaping the workspace_mount. Compare path parts, not string
+    # prefixes, so a sibling like "workspace_mount_evil" doesn't pass.
+    if not target_path.is_relative_to(MOUNT_DIR):
         raise ValueError(f"Access denied: {filename} is outside the workspace.")
         
     return target_path
 
+# Literal "\\n"/"\\t" escapes, and a Markdown fence on the first / last line
+_ESC_RE = re.compile(r"\\[nt]")
+_ESC_MAP = {"\\n": "\n", "\\t": "\t"}
+_FENCE_OPEN_RE = re.compile(r"\A[^\S\n]*```[^\n]*(?:\n|\Z)")
+_FENCE_CLOSE_RE = re.compile(r"(?:\A|\n)[^\S\n]*```[^\S\n]*\Z")
+
 def _clean_content(content: str) -> str:
     if not content: return content
-    if "\\u" in content:
-        try: content = content.encode('utf-8').decode('unicode_escape')
-        except: pass
-    content = content.replace("\\n", "\n").replace("\\t", "\t")
-    lines = content.split('\n')
-    if lines and lines[0].strip().startswith("```"): lines = lines[1:]
-    if lines and lines[-1].strip() == "```": lines = lines[:-1]
-    return "\n".join(lines)
+    if "\\" in content:
+        if "\\u" in content:
+            try: content = content.encode('utf-8').decode('unicode_escape')
+            except: pass
+        content = _ESC_RE.sub(lambda m: _ESC_MAP[m.group()], content)
+    if "```" in content:
+        content = _FENCE_OPEN_RE.sub("", content, count=1)
+        content = _FENCE_CLOSE_RE.sub("", content, count=1)
+    return content
+
+# blake2b(content) -> (valid, error); repeated edits of one module re-check identical text often
+_AST_CACHE: "OrderedDict[bytes, tuple[bool, str]]" = OrderedDict()
+_AST_LOCK = threading.Lock()
 
 def _is_valid_python(content: str) -> tuple[bool, str]:
+    key = hashlib.blake2b(content.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    with _AST_LOCK:
+        hit = _AST_CACHE.get(key)
+        if hit is not None:
+            _AST_CACHE.move_to_end(key)
+            return hit
+    result = _parse_check(content)
+    with _AST_LOCK:
+        _AST_CACHE[key] = result
+        if len(_AST_CACHE) > AST_CACHE_SIZE:
+            _AST_CACHE.popitem(last=False)
+    return result
+
+def _parse_check(content: str) -> tuple[bool, str]:
     try:
         ast.parse(content)
         return True, ""
@@ -85,21 +239,184 @@ def _is_valid_python(content: str) -> tuple[bool, str]:
     except Exception as e:
         return True, ""
 
-def _setup_git_config(container):
-    """Ensures git is usable inside the container."""
-    container.exec_run("git config --global --add safe.directory /workspace")
-    container.exec_run(f"git config --global user.email '{GITHUB_USER}@bot.com'")
-    container.exec_run(f"git config --global user.name '{GITHUB_USER}'")
+# Path -> (st_mtime_ns, st_size, text); an entry is valid while the file's stat matches
+_READ_CACHE: "OrderedDict[str, tuple[int, int, str]]" = OrderedDict()
+_READ_LOCK = threading.Lock()
+
+def _read_text_cached(target_path: Path) -> str:
+    """Reads a workspace file, serving unchanged files from memory."""
+    key = str(target_path)
+    st = target_path.stat()
+    with _READ_LOCK:
+        hit = _READ_CACHE.get(key)
+        if hit and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+            _READ_CACHE.move_to_end(key)
+            return hit[2]
+    text = target_path.read_text(encoding="utf-8")
+    _store_read(key, st, text)
+    return text
+
+def _store_read(key: str, st: os.stat_result, text: str):
+    with _READ_LOCK:
+        _READ_CACHE[key] = (st.st_mtime_ns, st.st_size, text)
+        _READ_CACHE.move_to_end(key)
+        if len(_READ_CACHE) > READ_CACHE_SIZE:
+            _READ_CACHE.popitem(last=False)
+
+def _may_contain(target_path: Path, needle: bytes) -> bool:
+    """Cheap pre-check for large files: a byte search over an mmap, without decoding to str."""
+    if not needle or target_path.stat().st_size < MMAP_THRESHOLD:
+        return True
+    with open(target_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm.find(needle) != -1
+
+def _write_text_cached(target_path: Path, text: str):
+    """Writes a workspace file and caches what was written, so read-back skips the mount."""
+    target_path.write_text(text, encoding="utf-8")
+    if "\r" in text:
+        # Cache what read_text() would return: it applies universal-newline translation
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    _store_read(str(target_path), target_path.stat(), text)
+
+def _setup_git_config():
+    """Ensures git is usable inside the container (once per container lifetime)."""
+    global _GIT_CONFIGURED
+    if _GIT_CONFIGURED:
+        return
+    res = _exec(
+        "git config --global --add safe.directory /workspace"
+        f" && git config --global user.email {shlex.quote(f'{GITHUB_USER}@bot.com')}"
+        f" && git config --global user.name {shlex.quote(str(GITHUB_USER))}"
+    )
+    _GIT_CONFIGURED = res.exit_code == 0
+
+# Shared PyPI connection pool sized for the lookup workers
+_PYPI_SESSION = requests.Session()
+_PYPI_SESSION.mount("https://", HTTPAdapter(pool_connections=PYPI_WORKERS, pool_maxsize=PYPI_WORKERS))
+# canonical name -> (fetched_at, [(version, requires_python)] for final, non-yanked releases, newest first)
+_PYPI_CACHE: dict[str, tuple[float, list[tuple[Version, str | None]]]] = {}
+
+def _canonical(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def _fetch_releases(name: str):
+    try:
+        resp = _PYPI_SESSION.get(f"https://pypi.org/pypi/{name}/json", timeout=10)
+        releases = []
+        if resp.status_code == 200:
+            for version, files in resp.json()["releases"].items():
+                live = [f for f in files if not f.get("yanked")]
+                try:
+                    parsed = Version(version)
+                except InvalidVersion:
+                    continue
+                if live and not parsed.is_prerelease:
+                    releases.append((parsed, live[0].get("requires_python")))
+            releases.sort(key=lambda r: r[0], reverse=True)
+    except (requests.RequestException, ValueError, KeyError):
+        return  # Transient failure: leave uncached so the next call retries
+    _PYPI_CACHE[_canonical(name)] = (time.monotonic(), releases)
+
+def _latest_compatible(releases, python_version: str) -> str | None:
+    """Newest release whose Requires-Python admits the sandbox interpreter (as pip would pick)."""
+    for version, requires_python in releases:
+        try:
+            if not requires_python or SpecifierSet(requires_python).contains(python_version):
+                return str(version)
+        except InvalidSpecifier:
+            return str(version)  # pip ignores unparsable metadata too
+    return None
+
+def _is_newer(latest: str, installed: str) -> bool:
+    try:
+        return Version(latest) > Version(installed)
+    except InvalidVersion:
+        return latest != installed
+
+# Keep-alive session for the GitHub API. POST is retried on gateway errors too: a PR that was
+# created before the error comes back as a 422 "already exists", which create_github_pr accepts.
+_GH_SESSION = requests.Session()
+_GH_SESSION.headers.update({
+    "Authorization": f"token {GITHUB_TOKEN}",
+    "Accept": "application/vnd.github.v3+json"
+})
+_GH_SESSION.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+    allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False,
+)))
+
+def _exact_replace(content: str, find_clean: str, replace_clean: str) -> str | None:
+    """Fast path: `find` occurs verbatim and spans whole lines, so no line split is needed.
+
+    Only taken when the needle's first line occurs once in the whole file: otherwise an earlier,
+    differently indented block could be the first fuzzy match, and that one must win.
+    """
+    pos = content.find(find_clean) if find_clean else -1
+    if pos == -1 or content.count(find_clean.split("\n", 1)[0].strip()) != 1:
+        return None
+    end = pos + len(find_clean)
+    indent = content[content.rfind("\n", 0, pos) + 1:pos]
+    if indent.strip() or content[end:end + 1] not in ("", "\n"):
+        return None  # Partial-line match: leave it to the line-based search
+    return content[:pos] + replace_clean.replace("\n", "\n" + indent) + content[end:]
+
+def _fuzzy_replace(content: str, find_clean: str, replace_clean: str) -> str | None:
+    """Line-based search ignoring surrounding whitespace; re-indents the replacement to the match."""
+    file_lines = content.split('\n')
+    find_lines = find_clean.split('\n')
+    start_index = -1
+    detected_indent = ""
+    
+    # Strip every line exactly once; candidates then compare as whole list slices
+    stripped = [line.strip() for line in file_lines]
+    stripped_find = [line.strip() for line in find_lines]
+    n = len(stripped_find)
+    first = stripped_find[0]
+    
+    for i in range(len(stripped) - n + 1):  # A block can't start later than this
+        if stripped[i] == first and stripped[i:i + n] == stripped_find:
+            start_index = i
+            line = file_lines[i]
+            detected_indent = line[:len(line) - len(line.lstrip())]  # Only the matched line needs it
+            break
+    
+    if start_index == -1: return None
+    
+    replace_lines = replace_clean.split('\n')
+    indented_replace = [detected_indent + line for line in replace_lines]
+    
+    new_file_lines = file_lines[:start_index] + indented_replace + file_lines[start_index + len(find_lines):]
+    return "\n".join(new_file_lines)
+
+# list_files output, valid while the directory mtimes it depends on are unchanged
+_LIST_CACHE = {"key": None, "output": None}
+
+def _listing_key():
+    """mtimes of the workspace root and its visible top-level dirs (the scope of find -maxdepth 2)."""
+    dirs = []
+    with os.scandir(MOUNT_DIR) as it:
+        for entry in it:
+            if not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False):
+                dirs.append((entry.name, entry.stat(follow_symlinks=False).st_mtime_ns))
+    return MOUNT_DIR.stat().st_mtime_ns, tuple(sorted(dirs))
+
+def _invalidate_listing():
+    _LIST_CACHE["key"] = None
 
 # --- TOOLS ---
 
 @mcp.tool
 def list_files() -> str:
     """Lists all files in the workspace."""
-    container = _get_container()
     try:
-        res = container.exec_run("find . -maxdepth 2 -not -path '*/.*'", workdir="/workspace")
-        return res.output.decode("utf-8")
+        key = _listing_key()
+        if _LIST_CACHE["key"] == key:
+            return _LIST_CACHE["output"]
+        res = _exec("find . -maxdepth 2 -not -path '*/.*'")
+        output = res.output.decode("utf-8")
+        if res.exit_code == 0:
+            _LIST_CACHE.update(key=key, output=output)
+        return output
     except Exception as e:
         return f"Error: {e}"
 
@@ -110,7 +427,7 @@ def read_file(filename: str) -> str:
         target_path = _sanitize_path(filename)
         if not target_path.exists():
             return "Error: File not found."
-        return target_path.read_text(encoding="utf-8")
+        return _read_text_cached(target_path)
     except Exception as e:
         return f"Error: {e}"
 
@@ -120,13 +437,26 @@ def write_file(filename: str, content: str) -> str:
     try:
         content = _clean_content(content)
         target_path = _sanitize_path(filename)
+        # Skip no-op rewrites: saves the write and keeps mtime (and the read cache) intact
+        try:
+            unchanged = (
+                target_path.is_file()
+                and target_path.stat().st_size == len(content.encode("utf-8"))
+                and _read_text_cached(target_path) == content
+            )
+        except UnicodeDecodeError:
+            unchanged = False  # Existing file isn't UTF-8 text, so it differs
+        if unchanged:
+            return f"Success: {filename} already has this content (no change)."
+
         # Check syntax if python
         if filename.endswith(".py"):
             valid, error = _is_valid_python(content)
             if not valid:
                 return f"Error: Invalid Python syntax. {error}"
         
-        target_path.write_text(content, encoding="utf-8")
+        _write_text_cached(target_path, content)
+        _invalidate_listing()
         return f"Successfully wrote to {filename}"
     except Exception as e:
         return f"Error: {e}"
@@ -142,42 +472,26 @@ def replace_in_file(filename: str, find: str, replace: str) -> str:
         target_path = _sanitize_path(filename)
         if not target_path.exists(): return "Error: File not found."
         
-        content = target_path.read_text(encoding="utf-8")
         find_clean = textwrap.dedent(find).strip()
         replace_clean = textwrap.dedent(replace).strip()
+        # Any match (exact or fuzzy) contains the needle's first line verbatim
+        if not _may_contain(target_path, find_clean.split('\n', 1)[0].strip().encode("utf-8")):
+            return "Error: Text to replace not found."
         
-        # Fuzzy search logic
-        file_lines = content.split('\n')
-        find_lines = find_clean.split('\n')
-        start_index = -1
-        detected_indent = ""
-        
-        for i in range(len(file_lines)):
-            if file_lines[i].strip() == find_lines[0].strip():
-                match = True
-                current_indent = file_lines[i][:len(file_lines[i]) - len(file_lines[i].lstrip())]
-                for j in range(len(find_lines)):
-                    if i + j >= len(file_lines) or file_lines[i+j].strip() != find_lines[j].strip():
-                        match = False
-                        break
-                if match:
-                    start_index = i
-                    detected_indent = current_indent
-                    break
-        
-        if start_index == -1: return "Error: Text to replace not found."
+        content = _read_text_cached(target_path)
         
-        replace_lines = replace_clean.split('\n')
-        indented_replace = [detected_indent + line for line in replace_lines]
-        
-        new_file_lines = file_lines[:start_index] + indented_replace + file_lines[start_index + len(find_lines):]
-        new_content = "\n".join(new_file_lines)
+        new_content = _exact_replace(content, find_clean, replace_clean)
+        if new_content is None:
+            new_content = _fuzzy_replace(content, find_clean, replace_clean)
+        if new_content is None: return "Error: Text to replace not found."
+        if new_content == content: return "Success: File already up to date (no change)."
         
         if filename.endswith(".py"):
             valid, error = _is_valid_python(new_content)
             if not valid: return f"Error: Resulting code has syntax errors: {error}"
             
-        target_path.write_text(new_content, encoding="utf-8")
+        _write_text_cached(target_path, new_content)
+        _invalidate_listing()
         return "Success: File updated."
     except Exception as e:
         return f"Error: {e}"
@@ -185,21 +499,50 @@ def replace_in_file(filename: str, find: str, replace: str) -> str:
 @mcp.tool
 def run_shell_command(command: str) -> str:
     """Executes a shell command in the sandbox."""
-    container = _get_container()
     try:
-        result = container.exec_run(f"bash -c '{command}'", workdir="/workspace")
+        result = _exec(command)
         return f"Exit Code {result.exit_code}:\n{result.output.decode('utf-8')}"
     except Exception as e:
         return f"Error: {e}"
 
 @mcp.tool
 def list_outdated_packages(package_name: str = "") -> str:
-    """Lists outdated packages. If package_name is specified, returns only that package."""
-    container = _get_container()
+    """
+    Lists outdated packages. If package_name is specified, returns only that package.
+    Latest versions come from pypi.org, limited to releases supporting the sandbox's Python;
+    a custom pip index configured inside the sandbox is not consulted.
+    """
     try:
-        # Ignore package_name arg to prevent crashes
-        res = container.exec_run("pip list --outdated --format=json", workdir="/workspace")
-        return res.output.decode("utf-8")
+        # Installed versions are local and fast; only the "latest" lookups need the network,
+        # so do those from here, concurrently and cached, instead of pip's serial per-package queries.
+        res = _exec(
+            "python -c 'import platform; print(platform.python_version())'"
+            " && pip list --format=json --disable-pip-version-check 2>/dev/null"
+        )
+        if res.exit_code != 0:
+            return f"Error: pip list failed: {res.output.decode('utf-8')}"
+        python_version, _, listing = res.output.decode("utf-8").partition("\n")
+        python_version = python_version.strip()
+        installed = json.loads(listing)
+        if package_name:
+            installed = [p for p in installed if _canonical(p["name"]) == _canonical(package_name)]
+
+        now = time.monotonic()
+        misses = [
+            p["name"] for p in installed
+            if now - _PYPI_CACHE.get(_canonical(p["name"]), (float("-inf"), []))[0] >= PYPI_CACHE_TTL
+        ]
+        if misses:
+            with ThreadPoolExecutor(max_workers=min(PYPI_WORKERS, len(misses))) as pool:
+                list(pool.map(_fetch_releases, misses))
+
+        outdated = []
+        for p in installed:
+            releases = _PYPI_CACHE.get(_canonical(p["name"]), (0.0, []))[1]
+            latest = _latest_compatible(releases, python_version)
+            if latest and _is_newer(latest, p["version"]):
+                outdated.append({"name": p["name"], "version": p["version"], "latest_version": latest})
+        return json.dumps(outdated)
     except Exception as e:
         return f"Error: {e}"
 
@@ -225,19 +568,19 @@ def git_clone(repo_url: str = "") -> str:
     else:
         auth_url = repo_url # Fallback, likely won't work for private repos without https
 
-    container = _get_container()
-    _setup_git_config(container)
+    _setup_git_config()
     
     try:
         # 3. CLEANUP: Delete existing files to allow 'git clone .' to work
         # Safety: We strictly perform this inside /workspace
         clean_cmd = "find . -mindepth 1 -delete" 
-        container.exec_run(f"bash -c '{clean_cmd}'", workdir="/workspace")
+        _exec(clean_cmd)
+        _invalidate_listing()
 
         # 4. CLONE
         # We clone into '.' (current dir) because the mount is the root of the project
         clone_cmd = f"git clone {auth_url} ." 
-        res = container.exec_run(f"bash -c '{clone_cmd}'", workdir="/workspace")
+        res = _exec(clone_cmd)
         
         if res.exit_code != 0:
             return f"Git Clone Failed: {res.output.decode('utf-8')}"
@@ -250,27 +593,24 @@ def git_clone(repo_url: str = "") -> str:
 @mcp.tool
 def git_create_branch(branch_name: str) -> str:
     """Creates and switches to a new git branch. Verifies the switch."""
-    container = _get_container()
-    _setup_git_config(container)
+    _setup_git_config()
     try:
-        # Auto-initialize if missing
-        if not (MOUNT_DIR / ".git").exists():
-            container.exec_run("git init", workdir="/workspace")
-            container.exec_run("git checkout -b main", workdir="/workspace")
-            
-        # 1. Try create (-b)
-        res = container.exec_run(f"git checkout -b {branch_name}", workdir="/workspace")
-        
-        # 2. If fail, try switch (maybe it exists)
-        if res.exit_code != 0:
-            res = container.exec_run(f"git checkout {branch_name}", workdir="/workspace")
-
-        # 3. VERIFY: Are we actually on the branch?
-        status = container.exec_run("git branch --show-current", workdir="/workspace")
-        current = status.output.decode('utf-8').strip()
+        b = shlex.quote(branch_name)
+        # One round trip: auto-initialize if missing, try create (-b), else switch (maybe it
+        # exists), then report the branch we actually ended up on after a marker line.
+        script = (
+            "{ [ -d .git ] || { git init && git checkout -b main; }; } >/dev/null 2>&1; "
+            f"git checkout -b {b} || git checkout {b}; "
+            "echo __BRANCH__; git branch --show-current"
+        )
+        res = _exec(script)
+        _invalidate_listing()  # Checkout may add/remove tracked files
+        output, _, current = res.output.decode('utf-8').rpartition("__BRANCH__\n")
+        current = current.strip()
         
+        # VERIFY: Are we actually on the branch?
         if current != branch_name:
-            return f"Error: Failed to switch. Git is still on '{current}'. Output: {res.output.decode('utf-8')}"
+            return f"Error: Failed to switch. Git is still on '{current}'. Output: {output}"
 
         return f"Git: Successfully switched to '{branch_name}'"
     except Exception as e:
@@ -278,11 +618,12 @@ def git_create_branch(branch_name: str) -> str:
 
 @mcp.tool
 def git_commit(message: str) -> str:
-    container = _get_container()
-    _setup_git_config(container)
+    _setup_git_config()
     try:
-        container.exec_run("git add .", workdir="/workspace")
-        res = container.exec_run(f"git commit -m '{message}'", workdir="/workspace")
+        res = _exec(f"git add . && git commit -m {shlex.quote(message)}")
+        if res.exit_code != 0:
+            # e.g. "nothing to commit": report it as a failure so the agent doesn't count it as done
+            return f"Error: git commit failed (exit {res.exit_code}):\n{res.output.decode('utf-8')}"
         return res.output.decode('utf-8')
     except Exception as e:
         return f"Git Commit Error: {e}"
@@ -299,13 +640,12 @@ def git_push(branch_name: str) -> str:
             "You must push to your feature branch (e.g., 'feat/upgrade-deps')."
         )
     
-    container = _get_container()
-    _setup_git_config(container)
+    _setup_git_config()
     remote_url = f"https://{GITHUB_TOKEN}@github.com/{REPO_OWNER}/{REPO_NAME}.git"
     try:
         # Force push support for testing
         cmd = f"git push {remote_url} {branch_name}"
-        res = container.exec_run(f"bash -c '{cmd}'", workdir="/workspace")
+        res = _exec(cmd)
         return f"Push Result: {res.output.decode('utf-8')}"
     except Exception as e:
         return f"Git Push Error: {e}"
@@ -325,14 +665,10 @@ def create_github_pr(title: str, body: str, head_branch: str, base_branch: str =
     if not GITHUB_TOKEN: return "Error: GITHUB_TOKEN not set."
     
     url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/pulls"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
     data = {"title": title, "body": body, "head": head_branch, "base": base_branch}
     
     try:
-        resp = requests.post(url, json=data, headers=headers)
+        resp = _GH_SESSION.post(url, json=data, timeout=10)
         
         # 1. Success (201 Created)
         if resp.status_code == 201:
@@ -360,5 +696,20 @@ def create_github_pr(title: str, body: str, head_branch: str, base_branch: str =
     except Exception as e:
         return f"Request Error: {e}"
 
+def _shutdown():
+    """Ends the sandbox shell (bash exits on stdin EOF) and releases pooled connections."""
+    global _SHELL
+    with _SHELL_LOCK:
+        if _SHELL is not None:
+            _SHELL.close()
+            _SHELL = None
+    _PYPI_SESSION.close()
+    _GH_SESSION.close()
+    if _CLIENT is not None:
+        _CLIENT.close()
+
 if __name__ == "__main__":
-    mcp.run()
\ No newline at end of file
+    try:
+        mcp.run()
+    finally:
+        _shutdown()
\ No newline at end of file
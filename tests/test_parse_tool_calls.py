@@ -0,0 +1,16 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent.main import parse_tool_calls
+
+
+def test_json_call_after_stray_brace_in_prose():
+    calls = parse_tool_calls('She said "hi {" then {"name":"read_file","arguments":{"filename":"a.py"}}')
+    assert [(c["name"], c["args"]) for c in calls] == [("read_file", {"filename": "a.py"})]
+
+
+def test_json_call_after_unclosed_brace():
+    calls = parse_tool_calls('Oops { then {"tool": "git_diff"}')
+    assert [c["name"] for c in calls] == ["git_diff"]
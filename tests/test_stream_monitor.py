@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent.main import ToolCallStreamMonitor
+
+
+def test_python_style_call_is_seen():
+    monitor = ToolCallStreamMonitor()
+    assert monitor.feed('read_file("a.py")\n') is False
+    assert monitor.seen_call
+
+
+def test_prose_after_python_call_stops():
+    monitor = ToolCallStreamMonitor()
+    assert monitor.feed('read_file("a.py")\n') is False
+    assert monitor.feed("Now I will look at the tests.\n") is True
+
+
+def test_prose_after_json_call_stops():
+    monitor = ToolCallStreamMonitor()
+    assert monitor.feed('{"name": "read_file",\n "arguments": {"filename": "a.py"}}\n') is False
+    assert monitor.seen_call
+    assert monitor.feed("Now I will look at the tests.\n") is True
+
+
+def test_prose_before_any_call_keeps_streaming():
+    monitor = ToolCallStreamMonitor()
+    assert monitor.feed("Let me read the file first.\n") is False
+    assert monitor.feed("```python\n") is False
+    assert monitor.feed('read_file("a.py")\n```\n') is False
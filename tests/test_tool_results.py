@@ -0,0 +1,38 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent.main import is_tool_error, next_has_edited, tool_result_text
+
+
+def blocks(text):
+    # Shape returned by langchain-mcp-adapters: text blocks with random ids
+    return [{"type": "text", "text": text, "id": "lc_0f6b2c1e"}]
+
+
+def test_result_text_ignores_block_ids():
+    assert tool_result_text(blocks("ok")) == tool_result_text([{"type": "text", "text": "ok", "id": "lc_other"}]) == "ok"
+    assert tool_result_text("plain") == "plain"
+
+
+def test_failed_write_does_not_count_as_edit():
+    content = tool_result_text(blocks("Error: Invalid Python syntax. SyntaxError on line 1: invalid syntax"))
+    assert is_tool_error(content)
+    assert next_has_edited("write_file", content, False) is False
+
+
+def test_failed_replace_does_not_count_as_edit():
+    content = tool_result_text(blocks("Error: Text to replace not found."))
+    assert next_has_edited("replace_in_file", content, False) is False
+
+
+def test_successful_write_counts_as_edit():
+    assert next_has_edited("write_file", tool_result_text(blocks("Successfully wrote to a.py")), False) is True
+
+
+def test_only_successful_commit_consumes_edits():
+    failed = tool_result_text(blocks("Error: git commit failed (exit 1):\nnothing to commit"))
+    assert next_has_edited("git_commit", failed, True) is True
+    assert next_has_edited("git_commit", "Git Commit Error: boom", True) is True
+    assert next_has_edited("git_commit", "[feat 1a2b3c] upgrade requests", True) is False